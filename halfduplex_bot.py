@@ -4,12 +4,15 @@ Mumble Half-Duplex Communication Bot
 Implements push-to-talk style communication in Mumble channels
 """
 import pymumble_py3
+from pymumble_py3.messages import ModUserState
+import asyncio
 import time
 import logging
 import signal
-import sys
 import threading
 from datetime import datetime
+from dataclasses import dataclass, fields
+from typing import Optional
 import configparser
 
 
@@ -18,35 +21,70 @@ class HalfDuplexBot:
         self.config = config
         self.mumble = None
         self.running = True
+        self._shutdown_event = threading.Event()
         self.current_speaker = None
+        self._last_revoke = 0
         self.target_channel = None
-        self.speak_timers = {}
         self.lock = threading.Lock()
 
+        # Hot-path copies of config values, avoiding dict lookups per audio chunk.
+        # Delays are integer nanoseconds to match time.monotonic_ns().
+        self._target_channel_id = None
+        self._username = config.username
+        self._speak_delay_ns = int(config.speak_delay * 1e9)
+        self._restore_delay_ns = int(config.restore_delay * 1e9)
+
+        # Sessions currently in the target channel, kept up to date from the
+        # user callbacks so lookups don't scan every user on the server
+        self._channel_members = set()
+
+        # Sessions the bot has muted, so restoring only unmutes those
+        self._muted = set()
+
+        # Latest restore deadline (time.monotonic_ns()) per user, and the users
+        # with a talk-burst in progress. Bursts are timed out by call_later()
+        # handles on an asyncio loop that connect() starts in its own thread,
+        # instead of one threading.Timer per audio chunk.
+        self._deadlines = {}
+        self._talking = set()
+        self._loop = None
+        self._loop_thread = None
+
         # Setup enhanced logging
-        level = logging.DEBUG if config['debug'] else logging.INFO
+        level = logging.DEBUG if config.debug else logging.INFO
         logging.basicConfig(
             level=level,
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         )
         self.logger = logging.getLogger('HalfDuplexBot')
 
+        # Checked before building per-chunk debug messages on the audio path
+        self._debug = self.logger.isEnabledFor(logging.DEBUG)
+
     def connect(self):
         """Connect to Mumble server"""
-        self.logger.info(f"Connecting to {self.config['server']}:{self.config['port']}")
+        self.logger.info(f"Connecting to {self.config.server}:{self.config.port}")
 
         self.mumble = pymumble_py3.Mumble(
-            self.config['server'],
-            self.config['username'],
-            port=self.config['port'],
-            password=self.config['password'],
-            certfile=self.config['certfile']
+            self.config.server,
+            self.config.username,
+            port=self.config.port,
+            password=self.config.password,
+            certfile=self.config.certfile
         )
 
         # Set callbacks
         self.mumble.callbacks.set_callback('sound_received', self.on_sound_received)
         self.mumble.callbacks.set_callback('connected', self.on_connected)
+        self.mumble.callbacks.set_callback('user_created', self.on_user_created)
         self.mumble.callbacks.set_callback('user_updated', self.on_user_updated)
+        self.mumble.callbacks.set_callback('user_removed', self.on_user_removed)
+
+        # Start the scheduling loop before any audio can arrive
+        self._loop = asyncio.new_event_loop()
+        self._loop.call_later(60, self._log_status)
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
 
         # Start connection
         self.mumble.start()
@@ -59,20 +97,25 @@ class HalfDuplexBot:
         # Debug: Log all available channels
         self.logger.debug("Available channels:")
         for channel_id, channel in self.mumble.channels.items():
-            self.logger.debug(f"  {channel_id}: {channel['name']}")
+            self.logger.debug("  %s: %s", channel_id, channel['name'])
 
         # Find and join target channel
         channels = self.mumble.channels
         for channel_id, channel in channels.items():
-            if channel['name'] == self.config['channel']:
+            if channel['name'] == self.config.channel:
                 self.target_channel = channel
+                self._target_channel_id = channel['channel_id']
                 self.mumble.channels[channel_id].move_in()
                 self.logger.info(f"Joined channel: {channel['name']}")
                 break
 
         if not self.target_channel:
-            self.logger.error(f"Channel '{self.config['channel']}' not found!")
+            self.logger.error(f"Channel '{self.config.channel}' not found!")
             self.stop()
+        else:
+            # Seed the member index, the user callbacks keep it current from here
+            for user in list(self.mumble.users.values()):
+                self._track_channel_member(user)
 
         # Debug: Log initial users in channel
         self._log_channel_users()
@@ -81,62 +124,136 @@ class HalfDuplexBot:
         myself = self.mumble.users.myself
         self.logger.info(f"Bot info: {myself}")
 
+    def on_user_created(self, user):
+        """Track users connecting into the target channel"""
+        self._track_channel_member(user)
+
     def on_user_updated(self, user, actions):
-        """DEBUG: Log user updates"""
-        self.logger.debug(f"User updated: {user.get('name', 'Unknown')} - Actions: {actions}")
+        """Track users moving in or out of the target channel"""
+        self.logger.debug("User updated: %s - Actions: %s", user.get('name', 'Unknown'), actions)
+        if 'channel_id' in actions:
+            self._track_channel_member(user)
+
+    def on_user_removed(self, user, message):
+        """Forget users leaving the server"""
+        self._channel_members.discard(user['session'])
+        self._deadlines.pop(user['session'], None)
+
+    def _track_channel_member(self, user):
+        """Add or drop a user from the target channel member index"""
+        if user['channel_id'] == self._target_channel_id:
+            self._channel_members.add(user['session'])
+        else:
+            self._channel_members.discard(user['session'])
 
     def on_sound_received(self, user, soundchunk):
         """Handle incoming audio to detect speaking users"""
         # DEBUG: Log every sound event
-        self.logger.debug(f"Sound received from {user.get('name', 'Unknown')} (ID: {user.get('session')})")
-
-        if not self.target_channel or not self.running:
-            self.logger.debug("No target channel or not running")
-            return
-
-        # Check if user is in our target channel
-        if user['channel_id'] != self.target_channel['channel_id']:
-            self.logger.debug(f"User {user.get('name')} not in target channel")
+        if self._debug:
+            self.logger.debug("Sound received from %s (ID: %s)", user.get('name', 'Unknown'), user.get('session'))
+
+        # Check if user is in our target channel. _target_channel_id stays None
+        # until the channel is joined, so this also rejects audio before that.
+        if user['channel_id'] != self._target_channel_id or not self.running:
+            if self._debug:
+                self.logger.debug("User %s not in target channel or not running", user.get('name'))
             return
 
         user_id = user['session']
         username = user['name']
 
         # Don't process audio from the bot itself
-        if username == self.config['username']:
+        if username == self._username:
+            return
+
+        # Push back the restore deadline for this user. Single dict operations
+        # are atomic under the GIL, so the audio path takes no lock.
+        self._deadlines[user_id] = time.monotonic_ns() + self._restore_delay_ns
+        if self._debug:
+            self.logger.debug("Set restore deadline for %s", username)
+
+        if user_id not in self._talking and self._start_burst(user_id):
+            # Only the first chunk of a burst crosses into the loop thread, later
+            # deadlines are picked up when the restore handle fires
+            self._loop.call_soon_threadsafe(self._check_deadline, user_id)
+            self.on_talk_state_changed(user_id, True, username)
+        elif self.current_speaker != user_id:
+            # Retry a claim turned down by the floor hold-off, or take over a
+            # floor released while this burst was going on
+            self._claim_floor(user_id, username)
+
+    def on_talk_state_changed(self, user_id, talking, username=None):
+        """Handle a user starting or stopping a talk-burst, username is given on start"""
+        if not talking:
+            self._restore_speak_permissions(user_id)
             return
 
-        self.logger.info(f"VOICE ACTIVITY: {username} is speaking")
+        self.logger.info(f"VOICE ACTIVITY: {username} started speaking")
+        self._claim_floor(user_id, username)
 
-        # Cancel any pending restore timer for this user
+    def _claim_floor(self, user_id, username):
+        """Make a talking user the current speaker unless the floor is held"""
+        now = time.monotonic_ns()
+
+        # Take the floor under the lock so a restore running in the loop
+        # thread can't reset it right after we claimed it
         with self.lock:
-            if user_id in self.speak_timers:
-                self.speak_timers[user_id].cancel()
-                del self.speak_timers[user_id]
-                self.logger.debug(f"Cancelled restore timer for {username}")
+            previous_speaker = self.current_speaker
+            if previous_speaker == user_id:
+                return
 
-        # If this is a new speaker or speaker changed
-        if self.current_speaker != user_id:
-            self.logger.info(f"NEW SPEAKER: {username} (was: {self.current_speaker})")
+            # Hold the floor for speak_delay so crosstalk still in flight
+            # doesn't bounce it back and forth between speakers
+            if previous_speaker is not None and now - self._last_revoke < self._speak_delay_ns:
+                self.logger.debug("Ignoring %s, floor held by %s", username, previous_speaker)
+                return
 
             # Set as current speaker
-            previous_speaker = self.current_speaker
             self.current_speaker = user_id
+            self._last_revoke = now
+
+        self.logger.info(f"NEW SPEAKER: {username} (was: {previous_speaker})")
+
+        # Revoke speak permissions from others once per floor change
+        self._revoke_others_speak(user_id)
+
+    def _check_deadline(self, user_id):
+        """End a talk-burst once its deadline has passed, runs in the loop thread"""
+        remaining = self._deadlines.get(user_id, 0) - time.monotonic_ns()
+        if remaining > 0:
+            # More audio arrived since this handle was armed, wait for the rest
+            self._loop.call_later(remaining / 1e9, self._check_deadline, user_id)
+            return
+
+        with self.lock:
+            self._talking.discard(user_id)
+
+        # A chunk that arrived before the discard still saw the user talking, so
+        # it didn't start a new burst. Its deadline is already written, pick it
+        # back up here instead of ending the burst.
+        remaining = self._deadlines.get(user_id, 0) - time.monotonic_ns()
+        if remaining > 0:
+            if self._start_burst(user_id):
+                self._loop.call_later(remaining / 1e9, self._check_deadline, user_id)
+            return
 
-            # Revoke speak permissions from others (with slight delay)
-            self.logger.info(f"Scheduling mute of others in {self.config['speak_delay']}s")
-            threading.Timer(self.config['speak_delay'],
-                            self._revoke_others_speak,
-                            args=(user_id,)).start()
+        self.on_talk_state_changed(user_id, False)
 
-        # Set timer to restore permissions when user stops speaking
+    def _start_burst(self, user_id):
+        """Mark a user as talking, True only for the caller that started the burst"""
+        # Test-and-set under the lock so the audio path and the loop thread
+        # never both arm a _check_deadline chain for the same burst
         with self.lock:
-            timer = threading.Timer(self.config['restore_delay'],
-                                    self._restore_speak_permissions,
-                                    args=(user_id,))
-            self.speak_timers[user_id] = timer
-            timer.start()
-            self.logger.debug(f"Set restore timer for {username}")
+            if user_id in self._talking:
+                return False
+            self._talking.add(user_id)
+            return True
+
+    def _log_status(self):
+        """Log bot status, rescheduling itself every minute"""
+        self.logger.info(f"Bot status: Running, current speaker: {self.current_speaker}")
+        self._log_channel_users()
+        self._loop.call_later(60, self._log_status)
 
     def _revoke_others_speak(self, speaker_id):
         """Revoke speak permission from all users except the speaker"""
@@ -149,53 +266,76 @@ class HalfDuplexBot:
         myself = self.mumble.users.myself
         self.logger.info(f"Bot permissions check - myself: {myself}")
 
-        for user in users_in_channel:
-            if user['session'] != speaker_id and user['name'] != self.config['username']:
-                try:
-                    self.logger.info(f"Attempting to mute: {user['name']}")
-                    # Try server-side mute
-                    user_obj = self.mumble.users[user['session']]
-                    user_obj.mute()
-                    self.logger.info(f"Mute command sent for {user['name']}")
-                except PermissionError as e:
-                    self.logger.error(f"Permission denied: {e}")
-                except Exception as e:
-                    self.logger.error(f"Failed to mute {user['name']}: {type(e).__name__}: {e}")
+        # Queue the mutes under the lock so they can't interleave with the
+        # unmutes of a restore running in the loop thread
+        with self.lock:
+            # The floor may have been released since it was granted
+            if self.current_speaker != speaker_id:
+                return
+
+            # Users still muted from an earlier burst need no second command
+            others = [user for user in users_in_channel
+                      if user['session'] != speaker_id and user['name'] != self._username
+                      and user['session'] not in self._muted]
+            self._muted.update(user['session'] for user in others)
+            try:
+                self.logger.info(f"Attempting to mute: {[user['name'] for user in others]}")
+                # Try server-side mute
+                self._bulk_mute([user['session'] for user in others])
+                self.logger.info(f"Mute commands queued for {len(others)} users")
+            except Exception as e:
+                self.logger.error(f"Failed to mute users: {type(e).__name__}: {e}")
 
     def _restore_speak_permissions(self, user_id):
         """Restore speak permissions when user stops speaking"""
         self.logger.info(f"EXECUTING UNMUTE: User ID {user_id}")
 
+        # Check, release the floor and unmute in one critical section, so a new
+        # speaker claiming the floor meanwhile is never reset or unmuted
         with self.lock:
-            if user_id in self.speak_timers:
-                del self.speak_timers[user_id]
+            # Only restore if this was the current speaker, and audio hasn't
+            # resumed since the deadline expired
+            if self.current_speaker != user_id or user_id in self._talking:
+                return
 
-        # Only restore if this was the current speaker
-        if self.current_speaker == user_id:
             self.logger.info(f"User {user_id} stopped speaking, restoring permissions")
             self.current_speaker = None
 
-            # Restore permissions for all users
-            users_in_channel = self._get_users_in_channel()
-
-            for user in users_in_channel:
-                if user['name'] != self.config['username']:
-                    try:
-                        self.logger.info(f"Attempting to unmute: {user['name']}")
-                        user_obj = self.mumble.users[user['session']]
-                        user_obj.unmute()
-                        self.logger.info(f"Unmute command sent for {user['name']}")
-                    except Exception as e:
-                        self.logger.error(f"Failed to unmute {user['name']}: {e}")
+            # Restore permissions for the users we muted
+            muted, self._muted = self._muted, set()
+
+            others = [user for user in map(self.mumble.users.get, muted) if user is not None]
+            try:
+                self.logger.info(f"Attempting to unmute: {[user['name'] for user in others]}")
+                self._bulk_mute([user['session'] for user in others], mute=False)
+                self.logger.info(f"Unmute commands queued for {len(others)} users")
+            except Exception as e:
+                self.logger.error(f"Failed to unmute users: {e}")
+
+    def _bulk_mute(self, sessions, mute=True):
+        """Queue a server-side mute/unmute for several users at once
+
+        Returns the lock of the last queued command, released once the whole
+        batch has been sent, or None if there was nothing to send.
+        """
+        # User.mute()/unmute() wait for the pymumble loop to send each command
+        # before queueing the next. Queueing them all without blocking lets the
+        # loop write every UserState back to back in a single pass.
+        actor = self.mumble.users.myself_session
+        lock = None
+        for session in sessions:
+            cmd = ModUserState(actor, {'session': session, 'mute': mute})
+            lock = self.mumble.execute_command(cmd, blocking=False)
+        return lock
 
     def _get_users_in_channel(self):
-        """Get list of users in target channel"""
+        """Get list of pymumble User objects in target channel"""
         users = []
-        if self.target_channel:
-            for session, user in self.mumble.users.items():
-                if user['channel_id'] == self.target_channel['channel_id']:
-                    users.append(user)
-                    self.logger.debug(f"User in channel: {user['name']} (ID: {session})")
+        for session in list(self._channel_members):
+            user = self.mumble.users.get(session)
+            if user is not None:
+                users.append(user)
+                self.logger.debug("User in channel: %s (ID: %s)", user['name'], session)
         return users
 
     def _log_channel_users(self):
@@ -207,47 +347,72 @@ class HalfDuplexBot:
         self.logger.info("=== END CHANNEL USERS ===")
 
     def run(self):
-        """Main bot loop with periodic status"""
+        """Block until the bot is stopped"""
         self.logger.info("Bot is running. Press Ctrl+C to stop.")
 
+        # Periodic status is logged from the scheduler thread
         try:
-            counter = 0
-            while self.running:
-                time.sleep(5)  # Check every 5 seconds
-                counter += 1
-                if counter % 12 == 0:  # Every minute
-                    self.logger.info(f"Bot status: Running, current speaker: {self.current_speaker}")
-                    self._log_channel_users()
+            self._shutdown_event.wait()
         except KeyboardInterrupt:
+            # Only reached by callers that don't install main()'s signal handler
             self.logger.info("Keyboard interrupt received")
+
+        # Signal handlers only set the event, the actual shutdown runs here
+        if self.running:
             self.stop()
 
+    def request_stop(self):
+        """Ask run() to stop the bot, safe to call from a signal handler"""
+        self._shutdown_event.set()
+
     def stop(self):
         """Stop the bot gracefully"""
         self.logger.info("Stopping bot...")
         self.running = False
 
-        # Cancel all timers
+        # Drop pending deadlines and stop the scheduling loop
         with self.lock:
-            for timer in self.speak_timers.values():
-                timer.cancel()
-            self.speak_timers.clear()
-
-        # Restore all permissions before leaving
+            self._deadlines.clear()
+            self._talking.clear()
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join(timeout=1)
+            if not self._loop.is_running():
+                self._loop.close()
+        self._shutdown_event.set()
+
+        # Restore permissions of everyone we muted before leaving
         if self.mumble and self.mumble.connected:
-            users = self._get_users_in_channel()
-            for user in users:
-                try:
-                    user_obj = self.mumble.users[user['session']]
-                    user_obj.unmute()
-                except:
-                    pass
+            with self.lock:
+                muted, self._muted = self._muted, set()
+            try:
+                sent = self._bulk_mute([session for session in muted if session in self.mumble.users],
+                                       mute=False)
+                if sent:
+                    # Let the pymumble loop flush the batch before disconnecting
+                    sent.acquire(timeout=1)
+            except:
+                pass
 
             self.mumble.stop()
 
         self.logger.info("Bot stopped")
 
 
+@dataclass(frozen=True, slots=True)
+class BotConfig:
+    """Typed, immutable bot settings, converted once by load_config()"""
+    server: str
+    port: int
+    username: str
+    password: str
+    channel: str
+    certfile: Optional[str]
+    speak_delay: float
+    restore_delay: float
+    debug: bool
+
+
 def load_config(config_file=None):
     """Load configuration from file"""
     CONFIG = {
@@ -268,42 +433,40 @@ def load_config(config_file=None):
 
         if 'bot' in config:
             CONFIG.update(dict(config['bot']))
-            # Convert numeric values
-            if 'port' in CONFIG:
-                CONFIG['port'] = int(CONFIG['port'])
-            if 'speak_delay' in CONFIG:
-                CONFIG['speak_delay'] = float(CONFIG['speak_delay'])
-            if 'restore_delay' in CONFIG:
-                CONFIG['restore_delay'] = float(CONFIG['restore_delay'])
-            if 'debug' in CONFIG:
-                CONFIG['debug'] = CONFIG['debug'].lower() == 'true'
 
-    return CONFIG
+    # Convert values read from the file
+    CONFIG['port'] = int(CONFIG['port'])
+    CONFIG['speak_delay'] = float(CONFIG['speak_delay'])
+    CONFIG['restore_delay'] = float(CONFIG['restore_delay'])
+    CONFIG['debug'] = str(CONFIG['debug']).lower() == 'true'
+
+    # Keys the bot doesn't use (e.g. channels) are left out
+    return BotConfig(**{field.name: CONFIG[field.name] for field in fields(BotConfig)})
 
 
 def main():
     """Main entry point"""
-    bot = None
-
-    def signal_handler(sig, frame):
-        if bot:
-            bot.stop()
-        sys.exit(0)
-
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
     config = load_config('halfduplex.conf')
 
     bot = HalfDuplexBot(config)
 
+    def signal_handler(sig, frame):
+        # Just wake run(), which stops the bot outside of signal context
+        bot.request_stop()
+
     try:
         bot.connect()
+
+        # Installed only once connected: connect() blocks in a lock acquire
+        # that a flag-only handler can't interrupt, so until then the default
+        # handlers still end the process
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+
         bot.run()
     except Exception as e:
         logging.error(f"Bot error: {e}")
-        if bot:
-            bot.stop()
+        bot.stop()
 
 
 if __name__ == '__main__':